@@ -1,77 +1,320 @@
+import argparse
+import asyncio
+import base64
+import hashlib
 import json
 import os
-import time
-from playwright.sync_api import sync_playwright
+import shutil
+from urllib.parse import urlsplit
+from extract_student_data import columns_path, to_columns, write_json
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 
 DATA_FILE = 'processing/student_data_both_parts_verified.json'
 OUTPUT_DIR = 'processing/storymaps_archive'
+CACHE_DIR = os.path.join(OUTPUT_DIR, '_cache')
+MAX_CONCURRENT_PAGES = 8
+BROWSER_POOL_SIZE = 2
+BROWSER_POOL_RECYCLE_AFTER = 100
+BROWSER_LAUNCH_ARGS = ['--disable-dev-shm-usage', '--no-zygote']
+CONTEXT_OPTIONS = {'viewport': {'width': 1280, 'height': 800}}
+BLOCKED_TYPES = {'font', 'media'}
+TEXT_ONLY_CONTEXT_OPTIONS = {**CONTEXT_OPTIONS, 'java_script_enabled': False}
+TEXT_ONLY_BLOCKED_TYPES = BLOCKED_TYPES | {'image'}
+BLOCKED_HOSTS = ('google-analytics.com', 'googletagmanager.com', 'doubleclick.net', 'hotjar.com')
+READY_TIMEOUT_MS = 10000
+READY_CHECK = "() => document.readyState === 'complete' && !!document.querySelector('.story, .esri-view-root, [data-item-id]') && !document.querySelector('.loading')"
 
-def scrape_storymaps():
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-    with sync_playwright() as p:
-        # Launch browser
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(viewport={'width': 1280, 'height': 800})
-        
-        for student_record in data:
-            student_name = student_record.get('student')
-            if not student_name:
-                continue
-                
-            print(f"Processing {student_name}...")
-            student_dir = os.path.join(OUTPUT_DIR, student_name)
-            os.makedirs(student_dir, exist_ok=True)
-            
-            urls_to_process = []
-            
-            # 1. Primary URL
-            url1 = student_record.get('storymap_url')
-            if url1:
-                urls_to_process.append(('part1', url1))
-            
-            # 2. Secondary URL (if mismatch)
-            if student_record.get('url_mismatch'):
-                url2 = student_record.get('storymap_url_2')
-                if url2:
-                    urls_to_process.append(('part2', url2))
-            
-            for label, url in urls_to_process:
-                output_path = os.path.join(student_dir, f"{label}.png")
-                
-                if os.path.exists(output_path):
-                    print(f"  - Skipping {label} (already exists)")
-                    continue
-                    
-                print(f"  - Downloading {label}: {url}")
-                
-                try:
-                    page = context.new_page()
-                    page.goto(url, wait_until='networkidle', timeout=60000)
-                    
-                    # Give it a little extra time for animations/maps
-                    time.sleep(5)
-                    
-                    # Remove some common cookie banners if possible (optional heuristic)
+def is_blocked_host(url):
+    host = urlsplit(url).hostname or ''
+    return any(host == h or host.endswith('.' + h) for h in BLOCKED_HOSTS)
+
+class BrowserPool:
+    """
+    Keeps a few Chromium instances alive and hands out contexts from a queue.
+    A context is closed and replaced once it has served `recycle_after` pages,
+    so memory stays bounded over long batches.
+    """
+
+    def __init__(self, playwright, size=BROWSER_POOL_SIZE, contexts=MAX_CONCURRENT_PAGES,
+                 recycle_after=BROWSER_POOL_RECYCLE_AFTER, context_options=CONTEXT_OPTIONS,
+                 blocked_types=BLOCKED_TYPES):
+        self.playwright = playwright
+        self.size = size
+        self.contexts = contexts
+        self.recycle_after = recycle_after
+        self.context_options = context_options
+        self.blocked_types = blocked_types
+        self.browsers = []
+        self.queue = asyncio.Queue()
+        self.page_counts = {}
+        self.owners = {}
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        for _ in range(self.size):
+            browser = await self.playwright.chromium.launch(headless=True, args=BROWSER_LAUNCH_ARGS)
+            self.browsers.append(browser)
+        for i in range(self.contexts):
+            await self.queue.put(await self._new_context(self.browsers[i % self.size]))
+        return self
+
+    async def _new_context(self, browser):
+        context = await browser.new_context(**self.context_options)
+        # Routed once per context (never per page) to avoid leaking handlers
+        await context.route("**/*", self._block_requests)
+        self.page_counts[context] = 0
+        self.owners[context] = browser
+        return context
+
+    async def _block_requests(self, route):
+        """
+        Aborts fonts, media and trackers that don't change the archived screenshot.
+        """
+        request = route.request
+        if request.resource_type in self.blocked_types or is_blocked_host(request.url):
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def checkout(self):
+        return await self._ensure_usable(await self.queue.get())
+
+    async def checkin(self, context):
+        self.page_counts[context] += 1
+        # Always return a context to the queue, or later checkouts would block forever
+        await self.queue.put(await self._ensure_usable(context))
+
+    async def _ensure_usable(self, context):
+        if self.page_counts[context] >= self.recycle_after or not self.owners[context].is_connected():
+            context = await self._replace_context(context)
+        return context
+
+    async def _replace_context(self, context):
+        """
+        Closes context and opens a fresh one, relaunching its browser if it
+        has crashed or disconnected. Never raises: if no replacement can be
+        made, the old context is kept and the next checkout/checkin retries.
+        """
+        try:
+            await context.close()
+        except Exception as e:
+            print(f"    -> Could not close browser context: {e}")
+
+        async with self.lock:
+            browser = self.owners.pop(context)
+            del self.page_counts[context]
+            try:
+                if not browser.is_connected():
+                    browser = await self._relaunch(browser)
+                return await self._new_context(browser)
+            except Exception as e:
+                print(f"    -> Could not replace browser context: {e}")
+                self.owners[context] = browser
+                self.page_counts[context] = self.recycle_after
+                return context
+
+    async def _relaunch(self, old_browser):
+        browser = await self.playwright.chromium.launch(headless=True, args=BROWSER_LAUNCH_ARGS)
+        self.browsers[self.browsers.index(old_browser)] = browser
+        # Contexts of the dead browser are unusable; move them over and mark
+        # them for replacement the next time they pass through the queue
+        for context, owner in self.owners.items():
+            if owner is old_browser:
+                self.owners[context] = browser
+                self.page_counts[context] = self.recycle_after
+        return browser
+
+    async def close(self):
+        for context in list(self.owners):
+            try:
+                await context.close()
+            except Exception:
+                pass
+        for browser in self.browsers:
+            try:
+                await browser.close()
+            except Exception:
+                pass
+
+def cache_path_for(url, text_only=False):
+    """
+    Screenshots are cached by URL so shared or re-run URLs are rendered once.
+    """
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    if text_only:
+        key += '_text'
+    return os.path.join(CACHE_DIR, key + '.png')
+
+def link_from_cache(cache_path, output_path):
+    try:
+        os.link(cache_path, output_path)
+    except OSError:
+        # Hardlinks can fail across filesystems; fall back to a copy
+        shutil.copyfile(cache_path, output_path)
+
+def write_cache(image, cache_path):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(image)
+    os.replace(tmp_path, cache_path)
+
+async def save_screenshot(image, cache_path):
+    """
+    Writes the PNG on a worker thread; the message is printed back on the
+    event loop so it can't interleave with other output.
+    """
+    await asyncio.to_thread(write_cache, image, cache_path)
+    print(f"    -> Saved to {cache_path}")
+
+async def capture_screenshot(context, page):
+    """
+    Captures the full page as PNG bytes via CDP, which renders beyond the
+    viewport without resizing it. Falls back to page.screenshot on CDP errors.
+    """
+    try:
+        cdp = await context.new_cdp_session(page)
+        try:
+            metrics = await cdp.send("Page.getLayoutMetrics")
+            size = metrics.get("cssContentSize") or metrics["contentSize"]
+            data = await cdp.send("Page.captureScreenshot", {
+                "format": "png",
+                "captureBeyondViewport": True,
+                "fromSurface": True,
+                "clip": {"x": 0, "y": 0, "width": size["width"], "height": size["height"], "scale": 1},
+            })
+        finally:
+            await cdp.detach()
+        return base64.b64decode(data["data"])
+    except Exception:
+        return await page.screenshot(full_page=True)
+
+def load_columns(data_file):
+    """
+    Loads the columnar variant of data_file (see extract_student_data.columns_path)
+    if it is up to date, else builds it from the records and saves it for next time.
+    """
+    columns_file = columns_path(data_file)
+    if os.path.exists(columns_file) and os.path.getmtime(columns_file) >= os.path.getmtime(data_file):
+        with open(columns_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    with open(data_file, 'r', encoding='utf-8') as f:
+        columns = to_columns(json.load(f))
+    write_json(columns_file, columns)
+    return columns
+
+def collect_urls(columns, suffix=''):
+    """
+    Flattens the student columns into a list of (student, label, url, output_path).
+    """
+    urls_to_process = []
+
+    for student_name, url1, url2, mismatch in zip(columns['student'], columns['url1'], columns['url2'], columns['mismatch']):
+        if not student_name:
+            continue
+
+        student_dir = os.path.join(OUTPUT_DIR, student_name)
+        os.makedirs(student_dir, exist_ok=True)
+
+        # 1. Primary URL
+        if url1:
+            urls_to_process.append((student_name, 'part1', url1, os.path.join(student_dir, f"part1{suffix}.png")))
+
+        # 2. Secondary URL (if mismatch)
+        if mismatch and url2:
+            urls_to_process.append((student_name, 'part2', url2, os.path.join(student_dir, f"part2{suffix}.png")))
+
+    return urls_to_process
+
+async def fetch(pool, writes, label, url, cache_path):
+    context = await pool.checkout()
+    try:
+        print(f"  - Downloading {label}: {url}")
+
+        try:
+            page = await context.new_page()
+            try:
+                await page.goto(url, wait_until='networkidle', timeout=60000)
+
+                # Wait until the StoryMap root has rendered instead of a fixed delay
+                # (without JS the root never renders, so there is nothing to wait for)
+                if pool.context_options.get('java_script_enabled', True):
                     try:
-                        page.evaluate("() => { const banners = document.querySelectorAll('.cookie-banner, #onetrust-banner-sdk'); banners.forEach(b => b.remove()); }")
-                    except:
-                        pass
-                        
-                    page.screenshot(path=output_path, full_page=True)
-                    print(f"    -> Saved to {output_path}")
-                    
-                    page.close()
-                    
-                except Exception as e:
-                    print(f"    -> FAILED {label}: {e}")
-
-        browser.close()
+                        await page.wait_for_function(READY_CHECK, timeout=READY_TIMEOUT_MS)
+                        await page.wait_for_load_state('networkidle')
+                    except PlaywrightTimeoutError:
+                        # Unknown layout: give it a little extra time for animations/maps
+                        await asyncio.sleep(2)
 
-if __name__ == "__main__":
-    scrape_storymaps()
+                # Remove some common cookie banners if possible (optional heuristic)
+                try:
+                    await page.evaluate("() => { const banners = document.querySelectorAll('.cookie-banner, #onetrust-banner-sdk'); banners.forEach(b => b.remove()); }")
+                except:
+                    pass
+
+                image = await capture_screenshot(context, page)
+                # Write on a worker thread so the next page load can start immediately
+                writes.append(asyncio.create_task(save_screenshot(image, cache_path)))
+            finally:
+                await page.close()
+
+        except Exception as e:
+            print(f"    -> FAILED {label}: {e}")
+    finally:
+        await pool.checkin(context)
+
+async def scrape_storymaps(text_only=False):
+    columns = load_columns(DATA_FILE)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
 
+    pending = []
+    urls_to_process = {}
+    for student_name, label, url, output_path in collect_urls(columns, '_text' if text_only else ''):
+        if os.path.exists(output_path):
+            print(f"  - Skipping {student_name}/{label} (already exists)")
+            continue
+        cache_path = cache_path_for(url, text_only)
+        pending.append((student_name, label, cache_path, output_path))
+        if not os.path.exists(cache_path) and url not in urls_to_process:
+            urls_to_process[url] = (f"{student_name}/{label}", cache_path)
 
+    print(f"Processing {len(urls_to_process)} StoryMaps ({MAX_CONCURRENT_PAGES} at a time)...")
+
+    try:
+        async with async_playwright() as p:
+            # One context per concurrent page, spread over a small pool of browsers
+            if text_only:
+                # No JS engine and no images: only the static text of each cover
+                pool = await BrowserPool(p, context_options=TEXT_ONLY_CONTEXT_OPTIONS,
+                                         blocked_types=TEXT_ONLY_BLOCKED_TYPES).start()
+            else:
+                pool = await BrowserPool(p).start()
+            writes = []
+
+            try:
+                await asyncio.gather(*[
+                    fetch(pool, writes, label, url, cache_path)
+                    for url, (label, cache_path) in urls_to_process.items()
+                ])
+            finally:
+                for result in await asyncio.gather(*writes, return_exceptions=True):
+                    if isinstance(result, Exception):
+                        print(f"    -> FAILED to write screenshot: {result}")
+                await pool.close()
+    finally:
+        # Link whatever reached the cache, even if the batch was cut short
+        for student_name, label, cache_path, output_path in pending:
+            if os.path.exists(cache_path):
+                try:
+                    link_from_cache(cache_path, output_path)
+                    print(f"  - Linked {student_name}/{label} -> {output_path}")
+                except OSError as e:
+                    print(f"  - FAILED to link {student_name}/{label}: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive student StoryMaps as screenshots.")
+    parser.add_argument('--textonly', action='store_true',
+                        help="Render with JavaScript and images disabled (saved as <label>_text.png).")
+    args = parser.parse_args()
+    asyncio.run(scrape_storymaps(text_only=args.textonly))
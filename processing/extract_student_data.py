@@ -3,20 +3,55 @@ import csv
 import json
 import sys
 import re
+import copy
+import hashlib
+import itertools
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 try:
-    import pandas as pd
+    import orjson
 except ImportError:
-    pd = None
+    orjson = None
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
 
 SOURCE_DIR_1 = 'lecture_checklists/cdspec_1'
 SOURCE_DIR_2 = 'lecture_checklists/cdspec_2'
 OUTPUT_FILE = 'processing/student_data.json'
+COLUMNS_SUFFIX = '_columns.json'
+EXTRACT_CACHE_FILE = 'processing/.cache/extract.json'
 LOG_FILE = 'processing/extraction_errors.log'
+MAX_SCAN_ROWS = 10 # Keys are always near the top; never read further than this
+MAX_HTML_SCAN_BYTES = 65536 # Redirect stubs keep their link in the first few KB
+
+# Held open by process_files so each message isn't an open/append/close
+LOG_FH = None
 
 def log_error(message):
     print(message)
-    with open(LOG_FILE, 'a', encoding='utf-8') as f:
-        f.write(message + '\n')
+    if LOG_FH is not None:
+        LOG_FH.write(message + '\n')
+    else:
+        with open(LOG_FILE, 'a', encoding='utf-8') as f:
+            f.write(message + '\n')
+
+KEY_RE = re.compile(r"community district|storymap url", re.IGNORECASE)
+
+def _cell_value(row, i, cell):
+    """
+    Returns the value for a key found in row[i]: the next cell if it has one,
+    otherwise whatever follows the colon in the same cell.
+    """
+    if i + 1 < len(row):
+        value = str(row[i+1]).strip()
+        if value:
+            return value
+    if ":" in cell:
+        return cell.split(":", 1)[1].strip() or None
+    return None
 
 def extract_from_rows(rows):
     """
@@ -25,187 +60,335 @@ def extract_from_rows(rows):
     """
     cd = None
     url = None
-    issues = False
 
     # Scan first 10 rows to find keys
-    for row in rows[:10]:
+    for row in rows[:MAX_SCAN_ROWS]:
         if not row:
             continue
-        # Convert all cells to string for safe checking
-        row_str = [str(cell).strip() for cell in row]
-        
-        # Look for Community District
-        if not cd:
-            for i, cell in enumerate(row_str):
-                if "community district" in cell.lower():
-                    # If value is in the next cell
-                    if i + 1 < len(row_str) and row_str[i+1]:
-                        cd = row_str[i+1]
-                    # Or if the value is in the same cell after a colon
-                    elif ":" in cell:
-                        parts = cell.split(":", 1)
-                        if len(parts) > 1 and parts[1].strip():
-                            cd = parts[1].strip()
-                    break
-        
-        # Look for StoryMap URL
-        if not url:
-            for i, cell in enumerate(row_str):
-                if "storymap url" in cell.lower():
-                    if i + 1 < len(row_str) and row_str[i+1]:
-                        url = row_str[i+1]
-                    elif ":" in cell:
-                        parts = cell.split(":", 1)
-                        if len(parts) > 1 and parts[1].strip():
-                            url = parts[1].strip()
-                    break
-    
-    if not cd or not url:
-        issues = True
-        
+
+        cd_found = url_found = False
+        for i, cell in enumerate(row):
+            s = str(cell)
+            m = KEY_RE.search(s)
+            if not m:
+                continue
+            # Only the first matching cell per row counts for each key
+            if m.group(0).lower().startswith('community'):
+                if not cd and not cd_found:
+                    cd_found = True
+                    cd = _cell_value(row, i, s)
+            elif not url and not url_found:
+                url_found = True
+                url = _cell_value(row, i, s)
+
+        if cd and url:
+            break
+
+    issues = not cd or not url
     return cd, url, issues
 
-def extract_url_from_html(filepath):
+def read_excel_rows(filepath):
+    """
+    Reads the first rows of the active sheet in streaming (read-only) mode.
+    """
+    if load_workbook is None:
+        raise ImportError("openpyxl library not available for Excel parsing.")
+
+    wb = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        return [['' if v is None else v for v in row]
+                for row in itertools.islice(ws.iter_rows(values_only=True), MAX_SCAN_ROWS)]
+    finally:
+        wb.close()
+
+def read_csv_rows_lenient(filepath):
+    """
+    Re-reads a CSV that the strict pass choked on: strips NUL bytes and
+    skips lines the csv module can't parse.
+    """
+    rows = []
+    with open(filepath, 'r', encoding='utf-8', errors='replace', newline='') as f:
+        for line in f:
+            try:
+                rows.extend(csv.reader([line.replace('\0', '')]))
+            except csv.Error:
+                continue
+            if len(rows) >= MAX_SCAN_ROWS:
+                break
+    return rows
+
+# Matches whichever redirect appears first, on raw bytes:
+#   <a href="https://arcg.is/15KnDO0">
+#   <meta http-equiv="Refresh" content="0; url=https://arcg.is/15KnDO0">
+HREF_OR_META_RE = re.compile(
+    rb'<a\s+[^>]*href=["\']([^"\']+)["\']|content=["\'][^"\']*url=([^"\';]+)',
+    re.IGNORECASE,
+)
+
+def extract_url_from_html(filepath, log=log_error):
     """
     Extracts the redirection URL from an HTML file.
     Checks for <a href="..."> and <meta ... url=...>
     """
     try:
-        with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-            
-            # Strategy 1: Check for anchor tag
-            # <a href="https://arcg.is/15KnDO0">
-            match = re.search(r'<a\s+[^>]*href=["\']([^"\']+)["\']', content, re.IGNORECASE)
-            if match:
-                return match.group(1)
-            
-            # Strategy 2: Check for meta refresh
-            # <meta http-equiv="Refresh" content="0; url=https://arcg.is/15KnDO0">
-            match = re.search(r'content=["\'][^"\']*url=([^"\';]+)', content, re.IGNORECASE)
-            if match:
-                return match.group(1)
+        with open(filepath, 'rb') as f:
+            # mmap can't map an empty file
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Only the head of the mapping is ever paged in
+                match = HREF_OR_META_RE.search(mm, 0, min(MAX_HTML_SCAN_BYTES, len(mm)))
+                # Groups slice the mapping, so read them before it is closed
+                if match:
+                    return (match.group(1) or match.group(2)).decode('utf-8', 'ignore')
                 
     except Exception as e:
-        log_error(f"HTML FAIL: {filepath} - {e}")
+        log(f"HTML FAIL: {filepath} - {e}")
         
     return None
 
-def process_files():
-    records = {}
-    
-    # Clear previous log
-    if os.path.exists(LOG_FILE):
-        os.remove(LOG_FILE)
+def columns_path(data_file):
+    """
+    Path of the columnar variant of a records file: <name>_columns.json.
+    """
+    return os.path.splitext(data_file)[0] + COLUMNS_SUFFIX
+
+def to_columns(data):
+    """
+    Columnar view of the records: parallel lists for the fields the
+    scraper and other downstream tools filter on.
+    """
+    return {
+        "student": [r.get("student") for r in data],
+        "url1": [r.get("storymap_url") for r in data],
+        "url2": [r.get("storymap_url_2") for r in data],
+        "mismatch": [bool(r.get("url_mismatch")) for r in data],
+    }
 
-    # --- PART 1: Process CSV/Excel Files ---
-    if not os.path.exists(SOURCE_DIR_1):
-        log_error(f"CRITICAL: Directory not found: {SOURCE_DIR_1}")
+def write_json(path, obj):
+    if orjson is not None:
+        Path(path).write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
     else:
-        files = os.listdir(SOURCE_DIR_1)
-        files.sort()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, indent=2)
+
+def parser_version():
+    """
+    Hash of this module's source plus which optional parsers are available.
+    Changing the parsing code or installing/removing openpyxl invalidates
+    every cached result, so stale results and log lines are never replayed.
+    """
+    with open(__file__, 'rb') as f:
+        source_hash = hashlib.sha1(f.read()).hexdigest()
+    return f"{source_hash}:openpyxl={load_workbook is not None}"
+
+def load_extract_cache():
+    """
+    Loads the per-file parse cache ({filepath: {"sha1": ..., "result": [...]}}).
+    A missing, corrupt or outdated (other parser version) cache just means
+    everything is parsed again.
+    """
+    try:
+        with open(EXTRACT_CACHE_FILE, 'rb') as f:
+            cache = orjson.loads(f.read()) if orjson is not None else json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("parser") != parser_version():
+        return {}
+    return cache.get("files", {})
+
+def save_extract_cache(files):
+    os.makedirs(os.path.dirname(EXTRACT_CACHE_FILE), exist_ok=True)
+    write_json(EXTRACT_CACHE_FILE, {"parser": parser_version(), "files": files})
+
+def file_sha1(filepath):
+    try:
+        with open(filepath, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def cached_map(ex, fn, filepaths, cache, new_cache):
+    """
+    Like ex.map(fn, filepaths), but files whose content hash matches the cache
+    reuse the stored result (including its log lines) instead of being parsed.
+    Fresh results are recorded in new_cache.
+    """
+    hashes = [file_sha1(fp) for fp in filepaths]
+    hits = [h is not None and cache.get(fp, {}).get("sha1") == h
+            for fp, h in zip(filepaths, hashes)]
+    # Submit all misses now; results are consumed in order below
+    fresh = ex.map(fn, [fp for fp, hit in zip(filepaths, hits) if not hit])
+
+    def results():
+        for fp, h, hit in zip(filepaths, hashes, hits):
+            result = tuple(cache[fp]["result"]) if hit else next(fresh)
+            if h is not None:
+                # Copy before the caller mutates records during the merge
+                new_cache[fp] = {"sha1": h, "result": copy.deepcopy(list(result))}
+            yield result
 
-        for filename in files:
-            filepath = os.path.join(SOURCE_DIR_1, filename)
+    return results()
+
+def _norm(url):
+    """
+    Comparison key for a StoryMap URL, interned so equal URLs share one object.
+    """
+    return sys.intern(url.strip().rstrip('/').lower()) if url else ""
+
+def _parse_part1(filepath):
+    """
+    Parses one Part 1 CSV/Excel file. Runs in a worker process, so messages
+    are buffered and returned instead of written to LOG_FILE.
+    Returns (student_name, record, log_lines)
+    """
+    log_lines = []
+    log = log_lines.append
+    filename = os.path.basename(filepath)
+    student_name = filename.split('_')[0]
+    needs_review = False
+    community_district = None
+    storymap_url = None
+    
+    # Strategy 1: Try reading as standard CSV
+    try:
+        # Check for binary/excel signature
+        is_binary = False
+        try:
+            with open(filepath, 'rb') as f:
+                header = f.read(4)
+                if header.startswith(b'PK'):
+                    is_binary = True
+        except:
+            pass
+
+        if is_binary:
+             raise ValueError("Detected Excel file signature")
+
+        with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
+            reader = csv.reader(f)
+            rows = list(itertools.islice(reader, MAX_SCAN_ROWS))
             
-            if filename.startswith('.'):
-                continue
-                
-            student_name = filename.split('_')[0]
-            needs_review = False
-            community_district = None
-            storymap_url = None
+            # Strict check
+            strict_ok = True
+            if len(rows) < 2:
+                strict_ok = False
+            else:
+                if "Community District" not in str(rows[0][0]): strict_ok = False
+                if "StoryMap URL" not in str(rows[1][0]): strict_ok = False
             
-            # Strategy 1: Try reading as standard CSV
-            try:
-                # Check for binary/excel signature
-                is_binary = False
-                try:
-                    with open(filepath, 'rb') as f:
-                        header = f.read(4)
-                        if header.startswith(b'PK'):
-                            is_binary = True
-                except:
-                    pass
-
-                if is_binary:
-                     raise ValueError("Detected Excel file signature")
-
-                with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
-                    reader = csv.reader(f)
-                    rows = list(reader)
-                    
-                    # Strict check
-                    strict_ok = True
-                    if len(rows) < 2:
-                        strict_ok = False
-                    else:
-                        if "Community District" not in str(rows[0][0]): strict_ok = False
-                        if "StoryMap URL" not in str(rows[1][0]): strict_ok = False
-                    
-                    if not strict_ok:
-                        log_error(f"DEVIANT FORMAT: {filename} - trying fuzzy search.")
-                        needs_review = True
-                    
-                    community_district, storymap_url, issues = extract_from_rows(rows)
-                    if issues:
-                        needs_review = True
-
-            except Exception as e_csv:
-                # Strategy 2: Try reading with Pandas
-                log_error(f"CSV FAIL: {filename} ({e_csv}). Attempting with Pandas...")
+            if not strict_ok:
+                log(f"DEVIANT FORMAT: {filename} - trying fuzzy search.")
                 needs_review = True
-                
-                try:
-                    if pd is None:
-                        raise ImportError("Pandas library not available for advanced parsing.")
-
-                    if str(e_csv) == "Detected Excel file signature" or filename.endswith('.xlsx') or filename.endswith('.xls'):
-                        df = pd.read_excel(filepath, header=None)
-                    else:
-                        df = pd.read_csv(filepath, header=None, on_bad_lines='skip', encoding_errors='replace')
-                    
-                    rows = df.values.tolist()
-                    community_district, storymap_url, issues = extract_from_rows(rows)
-                    
-                    if issues:
-                        log_error(f"PANDAS FAIL: {filename} - Still missing data after coercion.")
-                    else:
-                        log_error(f"RECOVERED: {filename} - Extracted data using Pandas/Fuzzy search.")
-
-                except Exception as e_pd:
-                    log_error(f"FATAL: Could not process {filename}. Error: {e_pd}")
-                    needs_review = True
-
-            # Final check for Part 1
-            if not community_district:
-                log_error(f"MISSING DATA: {filename} - No Community District found.")
-                needs_review = True
-            if not storymap_url:
-                log_error(f"MISSING DATA: {filename} - No StoryMap URL found.")
+            
+            community_district, storymap_url, issues = extract_from_rows(rows)
+            if issues:
                 needs_review = True
 
-            records[student_name] = {
-                "student": student_name,
-                "community_district": community_district,
-                "storymap_url": storymap_url, # Primary URL (usually from Part 1)
-                "needs_review": needs_review,
-                "part_1_completed": True
-            }
-
-    # --- PART 2: Process HTML Files ---
-    if os.path.exists(SOURCE_DIR_2):
-        files2 = os.listdir(SOURCE_DIR_2)
-        files2.sort()
+    except Exception as e_csv:
+        # Strategy 2: Try reading as Excel (openpyxl) or lenient CSV
+        log(f"CSV FAIL: {filename} ({e_csv}). Attempting fallback parser...")
+        needs_review = True
         
-        for filename in files2:
-            filepath = os.path.join(SOURCE_DIR_2, filename)
+        try:
+            if str(e_csv) == "Detected Excel file signature" or filename.endswith('.xlsx') or filename.endswith('.xls'):
+                rows = read_excel_rows(filepath)
+            else:
+                rows = read_csv_rows_lenient(filepath)
             
-            if filename.startswith('.') or not filename.endswith('.html'):
-                continue
-                
-            student_name = filename.split('_')[0]
-            url_2 = extract_url_from_html(filepath)
+            community_district, storymap_url, issues = extract_from_rows(rows)
+            
+            if issues:
+                log(f"FALLBACK FAIL: {filename} - Still missing data after coercion.")
+            else:
+                log(f"RECOVERED: {filename} - Extracted data using fallback parser/Fuzzy search.")
+
+        except Exception as e_fb:
+            log(f"FATAL: Could not process {filename}. Error: {e_fb}")
+            needs_review = True
+
+    # Final check for Part 1
+    if not community_district:
+        log(f"MISSING DATA: {filename} - No Community District found.")
+        needs_review = True
+    if not storymap_url:
+        log(f"MISSING DATA: {filename} - No StoryMap URL found.")
+        needs_review = True
+
+    record = {
+        "student": student_name,
+        "community_district": community_district,
+        "storymap_url": storymap_url, # Primary URL (usually from Part 1)
+        "needs_review": needs_review,
+        "part_1_completed": True
+    }
+    return student_name, record, log_lines
+
+def _parse_part2(filepath):
+    """
+    Extracts the URL from one Part 2 HTML file in a worker process.
+    Returns (student_name, url_2, log_lines)
+    """
+    log_lines = []
+    filename = os.path.basename(filepath)
+    student_name = filename.split('_')[0]
+    url_2 = extract_url_from_html(filepath, log=log_lines.append)
+    return student_name, url_2, log_lines
+
+def list_source_files(directory, suffix=''):
+    """
+    Returns sorted paths of the visible files in directory ending with suffix.
+    DirEntry caches its stat result, so no extra syscalls per file.
+    """
+    with os.scandir(directory) as it:
+        entries = [e for e in it
+                   if not e.name.startswith('.') and e.name.endswith(suffix) and e.is_file()]
+    return [e.path for e in sorted(entries, key=lambda e: e.name)]
+
+def process_files():
+    global LOG_FH
+
+    # Clear previous log and keep one buffered handle open for the run
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    LOG_FH = open(LOG_FILE, 'w', encoding='utf-8', buffering=1 << 16)
+    try:
+        _process_files()
+    finally:
+        LOG_FH.close()
+        LOG_FH = None
+
+def _process_files():
+    records = {}
+
+    files = list_source_files(SOURCE_DIR_1) if os.path.exists(SOURCE_DIR_1) else []
+    files2 = list_source_files(SOURCE_DIR_2, '.html') if os.path.exists(SOURCE_DIR_2) else []
+
+    # Unchanged files (same content hash) reuse last run's parse result
+    cache = load_extract_cache()
+    new_cache = {}
+
+    # Parsing is independent per file; fan it out and merge in order below
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        part1_results = cached_map(ex, _parse_part1, files, cache, new_cache)
+        part2_results = cached_map(ex, _parse_part2, files2, cache, new_cache)
+
+        # --- PART 1: Process CSV/Excel Files ---
+        if not os.path.exists(SOURCE_DIR_1):
+            log_error(f"CRITICAL: Directory not found: {SOURCE_DIR_1}")
+        else:
+            for student_name, record, log_lines in part1_results:
+                for line in log_lines:
+                    log_error(line)
+                record["_norm_url"] = _norm(record["storymap_url"])
+                records[student_name] = record
+
+        # --- PART 2: Process HTML Files ---
+        for (student_name, url_2, log_lines), filepath in zip(part2_results, files2):
+            for line in log_lines:
+                log_error(line)
+            filename = os.path.basename(filepath)
             
             if not url_2:
                 log_error(f"PART 2 FAIL: Could not extract URL from {filename}")
@@ -222,13 +405,14 @@ def process_files():
                 
                 url_1 = records[student_name].get("storymap_url")
                 
-                # Compare URLs
-                u1_clean = url_1.strip().rstrip('/').lower() if url_1 else ""
-                u2_clean = url_2.strip().rstrip('/').lower() if url_2 else ""
+                # Compare URLs (both interned, so equal keys hit the identity fast path)
+                u1_clean = records[student_name]["_norm_url"]
+                u2_clean = _norm(url_2)
                 
                 # If Part 1 URL missing, take Part 2
                 if not u1_clean and u2_clean:
                     records[student_name]["storymap_url"] = url_2
+                    records[student_name]["_norm_url"] = u2_clean
                     log_error(f"UPDATED: {student_name} - Using Part 2 URL (Part 1 missing).")
                     
                 elif u1_clean and u2_clean and u1_clean != u2_clean:
@@ -246,19 +430,23 @@ def process_files():
                     "needs_review": True,
                     "part_1_completed": False,
                     "part_2_completed": True,
-                    "note": "Found only in Part 2"
+                    "note": "Found only in Part 2",
+                    "_norm_url": _norm(url_2)
                 }
                 log_error(f"NEW STUDENT: {student_name} found in Part 2.")
 
     # Ensure output directory exists
     os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
     
-    data = list(records.values())
+    # Normalized keys are for in-run comparisons only
+    data = [{k: v for k, v in record.items() if k != "_norm_url"} for record in records.values()]
     
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2)
+    write_json(OUTPUT_FILE, data)
+    write_json(columns_path(OUTPUT_FILE), to_columns(data))
+
+    save_extract_cache(new_cache)
     
-    print(f"Processed {len(data)} student records. Output saved to {OUTPUT_FILE}")
+    print(f"Processed {len(data)} student records. Output saved to {OUTPUT_FILE} (columns: {columns_path(OUTPUT_FILE)})")
     print(f"Errors and warnings logged to {LOG_FILE}")
 
 if __name__ == "__main__":